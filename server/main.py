@@ -1,18 +1,35 @@
-from fastapi import FastAPI, HTTPException, Query, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
+from PIL import Image, ImageDraw
+import aiofiles
+import asyncio
 import io
+import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from functools import lru_cache
-import requests
+import httpx
+import orjson
 import uvicorn
 from typing import Optional
-import json
 
 app = FastAPI(title="NASA LROC WMTS Tile Server", version="3.0.0")
 
+# Per-request logging goes through a queue so stdio writes never stall the
+# event loop; set LOG_LEVEL=DEBUG to see tile-level traffic
+log = logging.getLogger("tiles")
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -25,11 +42,54 @@ app.add_middleware(
 # Configuration
 TILE_SIZE = 256
 TILES_DIR = Path("tiles")
-CACHE_SIZE = 200
+PREFETCH_WORKERS = 16
+PREFETCH_QUEUE_MAX = 100_000
 
 # NASA Trek WMTS tile server base URL
 WMTS_BASE = "https://trek.nasa.gov/tiles/Moon/EQ"
 
+# Headers sent with every NASA Trek request
+TREK_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Referer': 'https://trek.nasa.gov/'
+}
+
+# Shared async HTTP client - created at startup, closed at shutdown
+client: Optional[httpx.AsyncClient] = None
+
+# Process pool for CPU-bound image encodes, so transcoding during a big
+# prefetch uses every core instead of fighting the event loop for one
+ENCODE_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _transcode(data: bytes, tile_format: str) -> bytes:
+    """Re-encode image bytes into the product's storage format (runs in ENCODE_POOL)"""
+    img = Image.open(io.BytesIO(data))
+    buf = io.BytesIO()
+    if tile_format == 'png':
+        img.save(buf, 'PNG', optimize=True)
+    else:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(buf, 'JPEG', quality=90, optimize=True)
+    return buf.getvalue()
+
+
+# WebP variants are ~40% smaller than quality-90 JPEG at equal visual
+# quality; served to any client whose Accept header includes image/webp
+WEBP_QUALITY = 82
+
+
+def _encode_webp(data: bytes) -> bytes:
+    """Transcode tile bytes to WebP (runs in ENCODE_POOL)"""
+    img = Image.open(io.BytesIO(data))
+    buf = io.BytesIO()
+    img.save(buf, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return buf.getvalue()
+
+# Auto-cache tiles on startup (enabled when run directly, see __main__)
+AUTO_CACHE_ON_STARTUP = False
+
 # NASA Trek WMTS Products - using NASA's official tile service
 # Note: Only includes verified working layers
 LROC_PRODUCTS = {
@@ -62,6 +122,12 @@ LROC_PRODUCTS = {
     }
 }
 
+# Precompute per-product tile URL templates - the endpoint prefix never
+# changes, so each download is one %-interpolation instead of an f-string
+# rebuild of the whole URL
+for info in LROC_PRODUCTS.values():
+    info["_url_tmpl"] = f"{info['wmts_endpoint']}/%d/%d/%d.{info['tile_format']}"
+
 # Ensure directories exist
 TILES_DIR.mkdir(exist_ok=True)
 for product in LROC_PRODUCTS.keys():
@@ -70,84 +136,419 @@ for product in LROC_PRODUCTS.keys():
 # Tile cache
 tile_cache_file = Path("tile_cache.json")
 if tile_cache_file.exists():
-    with open(tile_cache_file, 'r') as f:
-        MAPS_CONFIG = json.load(f)
+    MAPS_CONFIG = orjson.loads(tile_cache_file.read_bytes())
 else:
     MAPS_CONFIG = {}
 
+_config_dirty = asyncio.Event()
 
-def save_cache():
-    """Save maps configuration to file"""
-    with open(tile_cache_file, 'w') as f:
-        json.dump(MAPS_CONFIG, f, indent=2)
 
+def _write_config():
+    tile_cache_file.write_bytes(orjson.dumps(MAPS_CONFIG, option=orjson.OPT_INDENT_2))
 
-@lru_cache(maxsize=CACHE_SIZE)
-def get_cached_tile(map_id: str, zoom: int, row: int, col: int) -> bytes:
-    """Get tile from cache or disk"""
-    tile_format = LROC_PRODUCTS[map_id]["tile_format"]
-    tile_path = TILES_DIR / map_id / f"tile_{zoom}_{row}_{col}.{tile_format}"
-    
-    if not tile_path.exists():
-        # Return blank tile
-        blank = Image.new('RGB', (TILE_SIZE, TILE_SIZE), color=(20, 20, 25))
-        img_io = io.BytesIO()
-        
-        from PIL import ImageDraw
-        draw = ImageDraw.Draw(blank)
-        text = f"LROC QuickMap\nZoom: {zoom}\nTile: {row},{col}\nNot cached yet"
-        draw.text((30, 80), text, fill=(120, 120, 130))
-        
-        blank.save(img_io, 'JPEG', quality=85)
-        return img_io.getvalue()
-    
-    with open(tile_path, 'rb') as f:
-        return f.read()
+
+def save_cache():
+    """Mark the maps configuration dirty - the flusher task writes it out"""
+    _config_dirty.set()
+
+
+async def flush_config():
+    """Write-behind flusher: coalesces bursts of save_cache() into one write"""
+    while True:
+        await _config_dirty.wait()
+        await asyncio.sleep(1)  # debounce
+        _config_dirty.clear()
+        await asyncio.to_thread(_write_config)
+
+
+@app.on_event("startup")
+async def startup():
+    """Seed tile stats and create the shared HTTP client for NASA Trek downloads"""
+    global client, ENCODE_POOL, PREFETCH_QUEUE
+    _migrate_flat_layout()
+    _scan_tile_store()
+    ENCODE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+    client = httpx.AsyncClient(
+        http2=True,
+        headers=TREK_HEADERS,
+        timeout=30,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    PREFETCH_QUEUE = asyncio.Queue(maxsize=PREFETCH_QUEUE_MAX)
+    for _ in range(PREFETCH_WORKERS):
+        _prefetch_workers.append(asyncio.create_task(prefetch_worker()))
+    asyncio.create_task(prune_neg_cache())
+    asyncio.create_task(flush_config())
+    if AUTO_CACHE_ON_STARTUP:
+        asyncio.create_task(auto_cache_tiles())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush pending config writes and close the shared HTTP client"""
+    global client, ENCODE_POOL
+    for worker in _prefetch_workers:
+        worker.cancel()
+    _prefetch_workers.clear()
+    if _config_dirty.is_set():
+        _config_dirty.clear()
+        await asyncio.to_thread(_write_config)
+    if client is not None:
+        await client.aclose()
+        client = None
+    if ENCODE_POOL is not None:
+        ENCODE_POOL.shutdown(wait=False)
+        ENCODE_POOL = None
+
+
+def _render_blank_tile() -> bytes:
+    """Render the 'not cached' placeholder tile once at import time"""
+    blank = Image.new('RGB', (TILE_SIZE, TILE_SIZE), color=(20, 20, 25))
+    draw = ImageDraw.Draw(blank)
+    draw.text((30, 80), "LROC QuickMap\nNot cached yet", fill=(120, 120, 130))
+    img_io = io.BytesIO()
+    blank.save(img_io, 'JPEG', quality=85)
+    return img_io.getvalue()
+
+
+# Pre-rendered placeholder - the JPEG encoder never runs at request time
+BLANK_TILE_BYTES = _render_blank_tile()
+
+
+class ByteLRU:
+    """LRU cache for encoded tile bytes, bounded by total payload size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: OrderedDict = OrderedDict()
+        self._current = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value: bytes):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._current -= len(old)
+            self._data[key] = value
+            self._current += len(value)
+            # Evict oldest entries until we fit the budget again
+            while self._current > self.max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self._current -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._current = 0
+
+
+# In-memory cache of hot tile bytes, bounded in MB (not entry count)
+TILE_CACHE_MB = int(os.environ.get("TILE_CACHE_MB", "128"))
+TILE_CACHE = ByteLRU(TILE_CACHE_MB << 20)
+
+
+def tile_file(product: str, zoom: int, row: int, col: int, tile_format: str) -> Path:
+    """
+    Path of a cached tile: tiles/{product}/{zoom}/{row}/{col}.{format}
+    Tiles are sharded by zoom and row so no directory holds more than 2^z
+    entries (a flat directory at zoom 7 would hold up to 16384^2 files).
+    """
+    return TILES_DIR / product / str(zoom) / str(row) / f"{col}.{tile_format}"
 
 
-def download_quickmap_tile(product: str, zoom: int, row: int, col: int) -> Optional[Image.Image]:
+def _migrate_flat_layout():
+    """One-time move of tiles from the legacy flat tile_{z}_{r}_{c}.{fmt} layout"""
+    for pid, info in LROC_PRODUCTS.items():
+        product_dir = TILES_DIR / pid
+        if not product_dir.exists():
+            continue
+        for entry in os.scandir(product_dir):
+            if not entry.is_file() or not entry.name.startswith("tile_"):
+                continue
+            stem, _, suffix = entry.name.rpartition('.')
+            parts = stem.split("_")
+            if len(parts) != 4:
+                continue
+            _, zoom, row, col = parts
+            new = product_dir / zoom / row / f"{col}.{suffix}"
+            new.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(entry.path, new)
+
+
+# Per-product tile counts and byte totals, kept current on every write so
+# /products and /info never have to rescan the tile directories
+TILE_STATS = {pid: {"count": 0, "bytes": 0} for pid in LROC_PRODUCTS}
+
+# Coordinates of tiles known to be on disk - turns the per-request
+# tile_path.exists() stat syscall into a set probe
+PRESENT: set = set()
+
+# Same idea for the lazily-built WebP variants, so webp-accepting
+# browsers don't pay a stat per request either
+WEBP_PRESENT: set = set()
+
+
+def _scan_tile_store():
     """
-    Download tile from NASA Trek WMTS tile service
+    Seed TILE_STATS and PRESENT with one os.scandir walk over
+    tiles/{product}/{zoom}/{row}/. scandir beats glob here: no Path
+    allocation or fnmatch per entry, and DirEntry carries a cached stat
+    so file sizes come without a second syscall.
+    """
+    for pid, info in LROC_PRODUCTS.items():
+        tile_format = info["tile_format"]
+        count = 0
+        total_bytes = 0
+        product_dir = TILES_DIR / pid
+        if product_dir.exists():
+            for zoom_entry in os.scandir(product_dir):
+                if not zoom_entry.is_dir():
+                    continue
+                for row_entry in os.scandir(zoom_entry.path):
+                    if not row_entry.is_dir():
+                        continue
+                    for tile_entry in os.scandir(row_entry.path):
+                        col, _, ext = tile_entry.name.partition('.')
+                        if ext.endswith('part'):
+                            # leftover from a streaming download that died
+                            # mid-transfer - never a servable tile
+                            try:
+                                os.remove(tile_entry.path)
+                            except OSError:
+                                pass
+                            continue
+                        try:
+                            key = (pid, int(zoom_entry.name), int(row_entry.name), int(col))
+                        except ValueError:
+                            continue
+                        if ext == 'webp':
+                            WEBP_PRESENT.add(key)
+                            continue
+                        if ext != tile_format:
+                            continue
+                        PRESENT.add(key)
+                        count += 1
+                        total_bytes += tile_entry.stat(follow_symlinks=False).st_size
+        TILE_STATS[pid] = {"count": count, "bytes": total_bytes}
+
+
+def _record_tile_write(product: str, zoom: int, row: int, col: int, size: int):
+    key = (product, zoom, row, col)
+    if key in PRESENT:
+        return  # already counted - a racing writer got there first
+    stats = TILE_STATS[product]
+    stats["count"] += 1
+    stats["bytes"] += size
+    PRESENT.add(key)
+
+
+# JPEG and PNG magic bytes - cheap sanity check on downloaded payloads
+IMAGE_MAGIC = (b'\xff\xd8\xff', b'\x89PN')
+
+# Negative cache of upstream 404s - stops re-hitting NASA Trek for tiles
+# that don't exist (e.g. out-of-range rows/cols at high zoom)
+NEG_TTL = 3600
+NEG_CACHE_MAX = 100_000
+NEG_CACHE: dict = {}
+
+
+def _neg_cache_put(key):
+    if len(NEG_CACHE) >= NEG_CACHE_MAX:
+        NEG_CACHE.clear()
+    NEG_CACHE[key] = time.monotonic()
+
+
+def _neg_cache_hit(key) -> bool:
+    ts = NEG_CACHE.get(key)
+    return ts is not None and time.monotonic() - ts < NEG_TTL
+
+
+async def prune_neg_cache():
+    """Periodically drop expired negative-cache entries"""
+    while True:
+        await asyncio.sleep(NEG_TTL)
+        cutoff = time.monotonic() - NEG_TTL
+        for key in [k for k, ts in NEG_CACHE.items() if ts < cutoff]:
+            NEG_CACHE.pop(key, None)
+
+
+async def download_quickmap_bytes(product: str, zoom: int, row: int, col: int) -> Optional[bytes]:
+    """
+    Download tile bytes from NASA Trek WMTS tile service
     Uses WMTS endpoint format: /{layer}/1.0.0/default/default028mm/{zoom}/{row}/{col}.{format}
+
+    NASA Trek already serves tiles in the product's format, so the payload
+    is returned verbatim - no PIL decode/re-encode round trip.
     """
+    key = (product, zoom, row, col)
+    if _neg_cache_hit(key):
+        log.debug(f"Negative cache hit, skipping download: {product} z{zoom} [{row},{col}]")
+        return None
+
     try:
         product_info = LROC_PRODUCTS[product]
         tile_format = product_info['tile_format']
-        wmts_endpoint = product_info['wmts_endpoint']
 
         # NASA Trek WMTS tile URL format: {wmts_endpoint}/{zoom}/{row}/{col}.{format}
-        tile_url = f"{wmts_endpoint}/{zoom}/{row}/{col}.{tile_format}"
+        tile_url = product_info['_url_tmpl'] % (zoom, row, col)
 
-        print(f"Downloading from NASA Trek: {product} z{zoom} [{row},{col}]")
-        print(f"URL: {tile_url}")
+        log.debug(f"Downloading from NASA Trek: {product} z{zoom} [{row},{col}] {tile_url}")
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Referer': 'https://trek.nasa.gov/'
-        }
-
-        response = requests.get(tile_url, headers=headers, timeout=30)
+        response = await client.get(tile_url)
         response.raise_for_status()
 
         # Verify we got an image
         content_type = response.headers.get('content-type', '')
-        if 'image' not in content_type.lower():
-            print(f"Warning: Unexpected content type: {content_type}")
+        data = response.content
+        if 'image' not in content_type.lower() or data[:3] not in IMAGE_MAGIC:
+            log.warning(f"Unexpected content type: {content_type}")
             return None
 
-        img = Image.open(io.BytesIO(response.content))
-        print(f"✓ Successfully downloaded tile: {img.size} {img.mode}")
-        return img
+        # Normalize payloads whose actual format differs from the product's
+        # storage format; the PIL encode runs in the process pool, off-loop
+        expected_magic = b'\x89PN' if tile_format == 'png' else b'\xff\xd8\xff'
+        if data[:3] != expected_magic:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(ENCODE_POOL, _transcode, data, tile_format)
+
+        log.debug(f"✓ Successfully downloaded tile: {len(data)} bytes")
+        return data
+
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            log.debug(f"Tile not available (404): {product} z{zoom} [{row},{col}]")
+            _neg_cache_put(key)
+        else:
+            log.warning(f"HTTP Error {e.response.status_code}: {e}")
+        return None
+    except Exception as e:
+        log.warning(f"Error downloading tile: {e}")
+        return None
+
+
+async def download_quickmap_to_file(product: str, zoom: int, row: int, col: int,
+                                    tile_path: Path) -> Optional[int]:
+    """
+    Stream a tile from NASA Trek straight to disk in 64KB chunks.
+
+    Used by the bulk prefetch paths where dozens of downloads are in
+    flight at once - the payload never sits whole in the Python heap.
+    Writes to a .part file and renames on success so a failed transfer
+    never leaves a truncated tile. Returns bytes written, or None.
+    """
+    key = (product, zoom, row, col)
+    if _neg_cache_hit(key):
+        log.debug(f"Negative cache hit, skipping download: {product} z{zoom} [{row},{col}]")
+        return None
+
+    product_info = LROC_PRODUCTS[product]
+    tile_format = product_info['tile_format']
+    tile_url = product_info['_url_tmpl'] % (zoom, row, col)
+    expected_magic = b'\x89PN' if tile_format == 'png' else b'\xff\xd8\xff'
 
-    except requests.exceptions.HTTPError as e:
+    part_path = tile_path.with_suffix(tile_path.suffix + '.part')
+    tile_path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    mismatched = False
+
+    try:
+        async with client.stream("GET", tile_url) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get('content-type', '')
+            if 'image' not in content_type.lower():
+                log.warning(f"Unexpected content type: {content_type}")
+                return None
+
+            first_chunk = True
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in response.aiter_bytes(65536):
+                    if first_chunk:
+                        first_chunk = False
+                        if chunk[:3] not in IMAGE_MAGIC:
+                            log.warning(f"Unexpected payload for {tile_url}")
+                            return None
+                        if chunk[:3] != expected_magic:
+                            mismatched = True
+                            break
+                    await f.write(chunk)
+                    written += len(chunk)
+
+        if mismatched:
+            # Wrong container format - refetch buffered so the process
+            # pool can transcode it into the product's storage format
+            data = await download_quickmap_bytes(product, zoom, row, col)
+            if data is None:
+                return None
+            await asyncio.to_thread(tile_path.write_bytes, data)
+            return len(data)
+
+        os.replace(part_path, tile_path)
+        return written
+
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 404:
-            print(f"Tile not available (404): {product} z{zoom} [{row},{col}]")
+            log.debug(f"Tile not available (404): {product} z{zoom} [{row},{col}]")
+            _neg_cache_put(key)
         else:
-            print(f"HTTP Error {e.response.status_code}: {e}")
+            log.warning(f"HTTP Error {e.response.status_code}: {e}")
         return None
     except Exception as e:
-        print(f"Error downloading tile: {e}")
+        log.warning(f"Error downloading tile: {e}")
         return None
+    finally:
+        if part_path.exists():
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+
+# Persistent prefetch queue drained by a fixed pool of worker coroutines.
+# /generate just enqueues coordinates and returns; worker count bounds the
+# upstream concurrency and QUEUED deduplicates across overlapping requests.
+PREFETCH_QUEUE: Optional[asyncio.Queue] = None
+QUEUED: set = set()
+_prefetch_workers: list = []
+
+
+async def _stream_and_record(product: str, zoom: int, row: int, col: int,
+                             tile_path: Path):
+    size = await download_quickmap_to_file(product, zoom, row, col, tile_path)
+    if size:
+        _record_tile_write(product, zoom, row, col, size)
+
+
+async def prefetch_worker():
+    """One consumer of PREFETCH_QUEUE - fetches queued tiles to disk"""
+    while True:
+        key = await PREFETCH_QUEUE.get()
+        product, zoom, row, col = key
+        QUEUED.discard(key)
+        try:
+            if key not in PRESENT:
+                # Share the singleflight map with /tile so a live request
+                # and the worker never fetch the same tile twice
+                task = INFLIGHT.get(key)
+                if task is None:
+                    tile_format = LROC_PRODUCTS[product]["tile_format"]
+                    tile_path = tile_file(product, zoom, row, col, tile_format)
+                    task = asyncio.create_task(
+                        _stream_and_record(product, zoom, row, col, tile_path))
+                    INFLIGHT[key] = task
+                    task.add_done_callback(lambda _, k=key: INFLIGHT.pop(k, None))
+                await task
+        except Exception as e:
+            log.warning(f"Prefetch worker error for {key}: {e}")
+        finally:
+            PREFETCH_QUEUE.task_done()
 
 
 @app.get("/")
@@ -175,7 +576,7 @@ async def list_products():
     products = []
     for pid, info in LROC_PRODUCTS.items():
         tile_format = info["tile_format"]
-        cached_tiles = len(list((TILES_DIR / pid).glob(f"*.{tile_format}")))
+        cached_tiles = TILE_STATS[pid]["count"]
         products.append({
             "id": pid,
             "name": info["name"],
@@ -191,62 +592,151 @@ async def list_products():
     }
 
 
+# Cached tiles never change for a given (product, zoom, row, col), so
+# browsers may treat them as immutable for a week
+TILE_CACHE_CONTROL = "public, max-age=604800, immutable"
+
+
+# In-flight downloads keyed by coordinate - concurrent misses for the same
+# tile await one shared task instead of each hitting NASA Trek
+INFLIGHT: dict = {}
+
+
+async def _download_and_store(product: str, zoom: int, row: int, col: int,
+                              tile_path: Path) -> Optional[bytes]:
+    data = await download_quickmap_bytes(product, zoom, row, col)
+    if data:
+        # Cache the upstream bytes as-is and serve the same buffer
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(tile_path.write_bytes, data)
+        TILE_CACHE.put((product, zoom, row, col), data)
+        _record_tile_write(product, zoom, row, col, len(data))
+    return data
+
+
+async def _get_tile_bytes(product: str, zoom: int, row: int, col: int,
+                          tile_path: Path) -> Optional[bytes]:
+    """Original-format tile bytes from memory, disk or upstream (caches on download)"""
+    key = (product, zoom, row, col)
+
+    data = TILE_CACHE.get(key)
+    if data is not None:
+        return data
+
+    if key in PRESENT:
+        return await asyncio.to_thread(tile_path.read_bytes)
+
+    # Singleflight: first miss starts the download, the rest await it
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(_download_and_store(product, zoom, row, col, tile_path))
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+        return await task
+
+    # The in-flight task may be a prefetch worker's streaming download,
+    # which lands on disk without returning the bytes
+    await task
+    data = TILE_CACHE.get(key)
+    if data is not None:
+        return data
+    if key in PRESENT:
+        return await asyncio.to_thread(tile_path.read_bytes)
+    return None
+
+
 @app.get("/tile/{product}/{zoom}/{row}/{col}")
-async def get_tile(product: str, zoom: int, row: int, col: int):
+async def get_tile(request: Request, product: str, zoom: int, row: int, col: int):
     """
     Get a tile - either from cache or download from LROC WMTS
     Uses WMTS tile scheme
     """
     if product not in LROC_PRODUCTS:
         raise HTTPException(status_code=404, detail=f"Product '{product}' not found")
-    
+
     if zoom < 0 or zoom > LROC_PRODUCTS[product]["max_zoom"]:
         raise HTTPException(
-            status_code=400, 
+            status_code=400,
             detail=f"Invalid zoom level. Valid range: 0-{LROC_PRODUCTS[product]['max_zoom']}"
         )
-    
+
     tile_format = LROC_PRODUCTS[product]["tile_format"]
-    tile_path = TILES_DIR / product / f"tile_{zoom}_{row}_{col}.{tile_format}"
-    
-    if tile_path.exists():
-        # Serve from cache
-        print(f"Serving from cache: {product} z{zoom} [{row},{col}]")
-        tile_data = get_cached_tile(product, zoom, row, col)
-        media_type = f"image/{tile_format}"
-    else:
-        # Download from LROC WMTS
-        img = download_quickmap_tile(product, zoom, row, col)
-        
-        if img:
-            # Save to cache
-            tile_path.parent.mkdir(parents=True, exist_ok=True)
-            if tile_format == 'png':
-                img.save(tile_path, 'PNG', optimize=True)
-            else:
-                img.save(tile_path, 'JPEG', quality=90, optimize=True)
-            
-            # Convert to bytes
-            img_io = io.BytesIO()
-            if tile_format == 'png':
-                img.save(img_io, 'PNG', optimize=True)
-            else:
-                img.save(img_io, 'JPEG', quality=90, optimize=True)
-            tile_data = img_io.getvalue()
-            media_type = f"image/{tile_format}"
-        else:
-            # Return blank tile on error
-            print(f"Returning blank tile for: {product} z{zoom} [{row},{col}]")
-            tile_data = get_cached_tile(product, zoom, row, col)
-            media_type = "image/jpeg"
-    
-    return StreamingResponse(io.BytesIO(tile_data), media_type=media_type)
+    tile_path = tile_file(product, zoom, row, col, tile_format)
+    wants_webp = "image/webp" in request.headers.get("accept", "")
+
+    # Tiles are content-addressed by coordinate and effectively immutable,
+    # so revalidation is a pure string compare - no disk involved
+    etag = f'"{product}-{zoom}-{row}-{col}{"-webp" if wants_webp else ""}"'
+    tile_headers = {
+        "Cache-Control": TILE_CACHE_CONTROL,
+        "ETag": etag,
+        "Vary": "Accept"
+    }
+
+    if request.headers.get("if-none-match") == etag:
+        # RFC 9110: a 304 carries the validator and caching headers so the
+        # client refreshes the stored response's freshness lifetime
+        return Response(status_code=304, headers=tile_headers)
+
+    if wants_webp:
+        # Serve (or lazily build) the smaller WebP variant
+        webp_key = (product, zoom, row, col, "webp")
+        webp_data = TILE_CACHE.get(webp_key)
+        if webp_data is None:
+            webp_path = tile_path.with_suffix(".webp")
+            if (product, zoom, row, col) in WEBP_PRESENT:
+                return FileResponse(webp_path, media_type="image/webp", headers=tile_headers)
+
+            tile_data = await _get_tile_bytes(product, zoom, row, col, tile_path)
+            if not tile_data:
+                log.debug(f"Returning blank tile for: {product} z{zoom} [{row},{col}]")
+                return Response(content=BLANK_TILE_BYTES, media_type="image/jpeg")
+
+            loop = asyncio.get_running_loop()
+            webp_data = await loop.run_in_executor(ENCODE_POOL, _encode_webp, tile_data)
+            webp_path.parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(webp_path.write_bytes, webp_data)
+            TILE_CACHE.put(webp_key, webp_data)
+            WEBP_PRESENT.add((product, zoom, row, col))
+        return Response(content=webp_data, media_type="image/webp", headers=tile_headers)
+
+    # Hot tiles come straight from memory
+    tile_data = TILE_CACHE.get((product, zoom, row, col))
+    if tile_data is not None:
+        return Response(
+            content=tile_data,
+            media_type=f"image/{tile_format}",
+            headers=tile_headers
+        )
+
+    if (product, zoom, row, col) in PRESENT:
+        # Serve straight from disk - sendfile(), no copy through the Python heap
+        # (FileResponse adds Last-Modified from the file's stat)
+        log.debug(f"Serving from cache: {product} z{zoom} [{row},{col}]")
+        return FileResponse(
+            tile_path,
+            media_type=f"image/{tile_format}",
+            headers=tile_headers
+        )
+
+    # Download from LROC WMTS
+    tile_data = await _get_tile_bytes(product, zoom, row, col, tile_path)
+    if tile_data:
+        return Response(
+            content=tile_data,
+            media_type=f"image/{tile_format}",
+            headers=tile_headers
+        )
+
+    # Return blank tile on error - not cacheable, the real tile may
+    # become available later
+    log.debug(f"Returning blank tile for: {product} z{zoom} [{row},{col}]")
+    return Response(content=BLANK_TILE_BYTES, media_type="image/jpeg")
 
 
 @app.post("/generate/{product}")
 async def generate_tiles(
     product: str,
-    background_tasks: BackgroundTasks,
     zoom: int = Query(2, ge=0, le=8),
     start_row: int = Query(0, ge=0),
     end_row: int = Query(4, ge=0),
@@ -255,61 +745,34 @@ async def generate_tiles(
 ):
     """
     Pre-cache tiles from LROC QuickMap for a specific region
-    Downloads tiles in the background
+    Enqueues the tiles for the persistent download worker pool
     """
     if product not in LROC_PRODUCTS:
         raise HTTPException(status_code=404, detail=f"Product '{product}' not found")
-    
+
     if zoom > LROC_PRODUCTS[product]["max_zoom"]:
         raise HTTPException(
-            status_code=400, 
+            status_code=400,
             detail=f"Max zoom for {product} is {LROC_PRODUCTS[product]['max_zoom']}"
         )
-    
-    tile_count = (end_row - start_row + 1) * (end_col - start_col + 1)
-    tile_format = LROC_PRODUCTS[product]["tile_format"]
-    
-    def download_tiles():
-        """Background task to download tiles"""
-        downloaded = 0
-        failed = 0
-        skipped = 0
-        
-        print(f"\nStarting tile cache generation for {product}")
-        print(f"Region: zoom={zoom}, rows={start_row}-{end_row}, cols={start_col}-{end_col}")
-        print(f"Total tiles to process: {tile_count}\n")
-        
-        for row in range(start_row, end_row + 1):
-            for col in range(start_col, end_col + 1):
-                tile_path = TILES_DIR / product / f"tile_{zoom}_{row}_{col}.{tile_format}"
-                
-                if tile_path.exists():
-                    skipped += 1
-                    continue
-                
-                img = download_quickmap_tile(product, zoom, row, col)
-                if img:
-                    tile_path.parent.mkdir(parents=True, exist_ok=True)
-                    if tile_format == 'png':
-                        img.save(tile_path, 'PNG', optimize=True)
-                    else:
-                        img.save(tile_path, 'JPEG', quality=90, optimize=True)
-                    downloaded += 1
-                    print(f"Cached tile [{row},{col}] ({downloaded + skipped}/{tile_count})")
-                else:
-                    failed += 1
-                    print(f"Failed tile [{row},{col}]")
-                    
-        
-        print(f"\nCache generation complete!")
-        print(f"Downloaded: {downloaded} tiles")
-        print(f"Skipped: {skipped} tiles (already cached)")
-        print(f"Failed: {failed} tiles\n")
-    
-    background_tasks.add_task(download_tiles)
-    
+
+    queued = 0
+    skipped = 0
+    for row in range(start_row, end_row + 1):
+        for col in range(start_col, end_col + 1):
+            key = (product, zoom, row, col)
+            if key in PRESENT or key in QUEUED:
+                skipped += 1
+                continue
+            try:
+                PREFETCH_QUEUE.put_nowait(key)
+            except asyncio.QueueFull:
+                raise HTTPException(status_code=503, detail="Prefetch queue is full, try again later")
+            QUEUED.add(key)
+            queued += 1
+
     return {
-        "message": f"Caching {tile_count} tiles in background",
+        "message": f"Queued {queued} tiles for caching ({skipped} already cached or queued)",
         "product": product,
         "product_name": LROC_PRODUCTS[product]["name"],
         "zoom": zoom,
@@ -317,6 +780,7 @@ async def generate_tiles(
             "rows": f"{start_row}-{end_row}",
             "cols": f"{start_col}-{end_col}"
         },
+        "queue_depth": PREFETCH_QUEUE.qsize(),
         "status": "Processing in background - check server logs for progress"
     }
 
@@ -328,17 +792,20 @@ async def clear_cache(product: str):
         raise HTTPException(status_code=404, detail=f"Product '{product}' not found")
     
     tiles_dir = TILES_DIR / product
-    deleted_count = 0
-    
+    deleted_count = TILE_STATS[product]["count"]
+
     if tiles_dir.exists():
-        tile_format = LROC_PRODUCTS[product]["tile_format"]
-        deleted_count = len(list(tiles_dir.glob(f"*.{tile_format}")))
         import shutil
         shutil.rmtree(tiles_dir)
         tiles_dir.mkdir()
-    
-    get_cached_tile.cache_clear()
-    
+
+    TILE_STATS[product] = {"count": 0, "bytes": 0}
+    for key in [k for k in PRESENT if k[0] == product]:
+        PRESENT.discard(key)
+    for key in [k for k in WEBP_PRESENT if k[0] == product]:
+        WEBP_PRESENT.discard(key)
+    TILE_CACHE.clear()
+
     return {
         "message": f"Cache cleared for {product}",
         "product_name": LROC_PRODUCTS[product]["name"],
@@ -353,20 +820,42 @@ async def product_info(product: str):
         raise HTTPException(status_code=404, detail=f"Product '{product}' not found")
     
     info = LROC_PRODUCTS[product].copy()
-    tile_format = info["tile_format"]
-    cached_files = list((TILES_DIR / product).glob(f"*.{tile_format}"))
-    cached_tiles = len(cached_files)
-    
-    cache_size = sum(f.stat().st_size for f in cached_files) / (1024 * 1024) if cached_tiles > 0 else 0
-    
-    info["cached_tiles"] = cached_tiles
-    info["cache_size_mb"] = round(cache_size, 2)
+    info.pop("_url_tmpl", None)  # internal, keep it out of the API response
+    stats = TILE_STATS[product]
+
+    info["cached_tiles"] = stats["count"]
+    info["cache_size_mb"] = round(stats["bytes"] / (1024 * 1024), 2)
     info["tile_size"] = TILE_SIZE
     info["source"] = "LROC WMTS"
     
     return info
 
 
+async def auto_cache_tiles():
+    """Automatically cache low zoom levels for products marked auto_cache=True"""
+    await asyncio.sleep(5)  # Wait for server to start
+    print("\n🔄 Starting automatic tile caching...")
+    for product_id, product_info in LROC_PRODUCTS.items():
+        if product_info.get('auto_cache', False):
+            print(f"📦 Auto-caching {product_info['name']}...")
+            # Cache zoom levels 0-3 for global coverage
+            for zoom in range(0, min(4, product_info['max_zoom'] + 1)):
+                tiles_at_zoom = 2 ** zoom
+                for row in range(tiles_at_zoom):
+                    for col in range(tiles_at_zoom):
+                        if (product_id, zoom, row, col) in PRESENT:
+                            continue
+                        try:
+                            tile_path = tile_file(product_id, zoom, row, col, product_info['tile_format'])
+                            size = await download_quickmap_to_file(product_id, zoom, row, col, tile_path)
+                            if size:
+                                _record_tile_write(product_id, zoom, row, col, size)
+                        except Exception as e:
+                            pass  # Continue on errors
+            print(f"✅ Completed auto-caching {product_info['name']}")
+    print("✅ Automatic tile caching complete!\n")
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -398,35 +887,7 @@ if __name__ == "__main__":
     print("="*70 + "\n")
 
     # Auto-cache tiles for products marked with auto_cache=True
-    import threading
-    def auto_cache_tiles():
-        import time
-        time.sleep(5)  # Wait for server to start
-        print("\n🔄 Starting automatic tile caching...")
-        for product_id, product_info in LROC_PRODUCTS.items():
-            if product_info.get('auto_cache', False):
-                print(f"📦 Auto-caching {product_info['name']}...")
-                # Cache zoom levels 0-3 for global coverage
-                for zoom in range(0, min(4, product_info['max_zoom'] + 1)):
-                    tiles_at_zoom = 2 ** zoom
-                    for row in range(tiles_at_zoom):
-                        for col in range(tiles_at_zoom):
-                            try:
-                                img = download_quickmap_tile(product_id, zoom, row, col)
-                                if img:
-                                    tile_path = TILES_DIR / product_id / f"tile_{zoom}_{row}_{col}.{product_info['tile_format']}"
-                                    tile_path.parent.mkdir(parents=True, exist_ok=True)
-                                    if product_info['tile_format'] == 'jpg':
-                                        img.save(tile_path, 'JPEG', quality=90, optimize=True)
-                                    else:
-                                        img.save(tile_path, 'PNG', optimize=True)
-                            except Exception as e:
-                                pass  # Continue on errors
-                print(f"✅ Completed auto-caching {product_info['name']}")
-        print("✅ Automatic tile caching complete!\n")
-
-    # Start auto-caching in background thread
-    cache_thread = threading.Thread(target=auto_cache_tiles, daemon=True)
-    cache_thread.start()
+    # (runs as an asyncio task scheduled by the startup event)
+    AUTO_CACHE_ON_STARTUP = True
 
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file